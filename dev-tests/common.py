@@ -11,6 +11,14 @@ def get_config_path():
     return Path(os.getenv('panda_config_dir'))
 
 
+def get_waves_path():
+    return os.getenv('sim_waves')
+
+
+def is_debug_build():
+    return os.getenv('sim_debug', '0') not in ('', '0')
+
+
 def get_extra_path():
     top = Path(__file__).parent.parent.resolve()
     return top / 'hdl'
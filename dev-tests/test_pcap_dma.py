@@ -4,19 +4,35 @@ import logging
 import numpy as np
 
 from cocotb.clock import Clock
+from cocotb.handle import Immediate
 from cocotb.triggers import RisingEdge, ReadOnly, ClockCycles, Event
-from cocotb_bus.monitors import BusMonitor
+from cocotb.types import LogicArray
 from cocotb_bus.drivers import BusDriver
 from cocotb_tools.runner import get_runner
 # can't use this yet until we move to AXI4
 #from cocotbext.axi import AxiWriteBus, AxiSlaveWrite
 
-from collections import deque
-from common import get_panda_path, get_extra_path
+from common import get_panda_path, get_extra_path, get_waves_path, \
+    is_debug_build
+from pathlib import Path
+from types import SimpleNamespace
 from typing import Any, Sequence
 
 TOP_PATH = get_panda_path()
 EXTRA_PATH = get_extra_path()
+DEBUG_BUILD = is_debug_build()
+WAVES_PATH = get_waves_path()
+WAVE_OPT_PATH = Path(__file__).parent.resolve() / 'pcap_dma.wave.opt'
+WAVE_FORMAT_OPTS = {
+    '.ghw': '--wave',
+    '.vcd': '--vcd',
+    '.fst': '--fst',
+}
+
+
+def _model_logger(cls):
+    # under the cocotb logger so COCOTB_LOG_LEVEL applies to the models
+    return logging.getLogger(f'cocotb.{cls.__name__}')
 
 
 @cocotb.test()
@@ -34,6 +50,7 @@ class PcapDriver(BusDriver):
 
     def __init__(self, dut, name, clock, **kwargs):
         super().__init__(dut, name, clock, **kwargs)
+        self._width = len(self.bus.pcap_dat_i)
         self.bus.pcap_wstb_i.value = 0
 
     async def finish(self):
@@ -44,15 +61,23 @@ class PcapDriver(BusDriver):
 
     async def _driver_send(self, transaction: Sequence[int], sync: bool = True,
                            **kwargs: Any) -> None:
+        # convert up front so the loop below is only assignments
+        values = [LogicArray.from_unsigned(int(data), self._width)
+                  for data in transaction]
         if sync:
             await RisingEdge(self.clock)
 
-        self.bus.pcap_wstb_i.value = 1
-        for data in transaction:
-            self.bus.pcap_dat_i.value = data
-            await RisingEdge(self.clock)
+        # Data and strobe are both written immediately so they stay aligned
+        # with each other while skipping the scheduled-write queue
+        clock = self.clock
+        pcap_dat_i = self.bus.pcap_dat_i
+        pcap_wstb_i = self.bus.pcap_wstb_i
+        pcap_wstb_i.value = Immediate(1)
+        for value in values:
+            pcap_dat_i.value = Immediate(value)
+            await RisingEdge(clock)
 
-        self.bus.pcap_wstb_i.value = 0
+        pcap_wstb_i.value = Immediate(0)
 
 
 class PcapAddressDriver(object):
@@ -63,16 +88,23 @@ class PcapAddressDriver(object):
         'dma_reset',
     ]
     def __init__(self, dut, addresses, block_size, delay_in_irq, **kwargs):
-        self.log = logging.getLogger(__class__.__name__)
+        self.log = _model_logger(__class__)
         self.dut = dut
         self.clock = dut.clk_i
+        self.dma_addr = dut.dma_addr
+        self.dma_addr_wstb = dut.dma_addr_wstb
         self.block_size = block_size
         self.delay_in_irq = delay_in_irq
         assert len(addresses) > 1, "At least 2 addresses must be provided"
-        self.addr_queue = deque(addresses)
-        self.dut.dma_addr.value = 0
-        self.dut.dma_reset.value = 0
-        self.dut.dma_init.value = 0
+        width = len(self.dma_addr)
+        self._addr_values = [LogicArray.from_unsigned(int(addr), width)
+                             for addr in addresses]
+        self._addr_index = 0
+        # All writes in this driver are immediate, the DUT only acts on them
+        # through strobes so their relative timing is what matters
+        self.dma_addr.value = Immediate(0)
+        self.dut.dma_reset.value = Immediate(0)
+        self.dut.dma_init.value = Immediate(0)
         self.init_event = Event()
         self.task = cocotb.start_soon(self.run())
 
@@ -81,45 +113,57 @@ class PcapAddressDriver(object):
 
     async def reset(self):
         await RisingEdge(self.clock)
-        self.dut.dma_reset.value = 1
-        await RisingEdge(self.clock)
-        self.dut.dma_reset.value = 0
+        self.dut.dma_reset.value = Immediate(1)
         await RisingEdge(self.clock)
+        self.dut.dma_reset.value = Immediate(0)
         await RisingEdge(self.clock)
 
     async def push_address(self, addr):
-        await RisingEdge(self.clock)
-        self.log.debug('Pushing DMA address 0x%x', addr)
-        self.dut.dma_addr.value = addr
-        self.dut.dma_addr_wstb.value = 1
-        await RisingEdge(self.clock)
-        self.dut.dma_addr_wstb.value = 0
-        await RisingEdge(self.clock)
+        clock = self.clock
+        dma_addr_wstb = self.dma_addr_wstb
+        await RisingEdge(clock)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('Pushing DMA address 0x%x', addr.to_unsigned())
+        self.dma_addr.value = Immediate(addr)
+        dma_addr_wstb.value = Immediate(1)
+        await RisingEdge(clock)
+        dma_addr_wstb.value = Immediate(0)
+
+    def next_address(self):
+        addr = self._addr_values[self._addr_index]
+        self._addr_index += 1
+        return addr
+
+    def has_addresses(self):
+        return self._addr_index < len(self._addr_values)
 
     async def run(self):
-        self.dut.block_size.value = self.block_size
+        self.dut.block_size.value = Immediate(self.block_size)
         await self.reset()
-        await self.push_address(self.addr_queue.popleft())
+        await self.push_address(self.next_address())
+        # keep dma_init apart from the address strobe
+        await RisingEdge(self.clock)
         assert self.dut.pcap_fsm.value == 0, "DMA FSM should be init"
-        self.dut.dma_init.value = 1
+        self.dut.dma_init.value = Immediate(1)
         await RisingEdge(self.clock)
-        self.dut.dma_init.value = 0
+        self.dut.dma_init.value = Immediate(0)
         await RisingEdge(self.clock)
         assert self.dut.pcap_fsm.value == 1, "DMA FSM should be active"
-        await self.push_address(self.addr_queue.popleft())
+        await self.push_address(self.next_address())
         self.init_event.set()
-        while self.addr_queue:
+        while self.has_addresses():
             await RisingEdge(self.dut.irq_o)
             await ClockCycles(self.clock, self.delay_in_irq)
-            await self.push_address(self.addr_queue.popleft())
+            await self.push_address(self.next_address())
 
 
 class Memory(object):
     def __init__(self, size):
-        self.log = logging.getLogger(__class__.__name__)
+        self.log = _model_logger(__class__)
+        assert size % 4 == 0, "Size must be a multiple of the word size"
         self.size = size
-        self.mem = bytearray(size)
-        self.word_view = np.frombuffer(self.mem, dtype=np.uint32)
+        self.word_view = np.zeros(size // 4, dtype=np.uint32)
+        self.mem = self.word_view.view(np.uint8)
 
     def clear(self):
         self.word_view.fill(0)
@@ -127,24 +171,33 @@ class Memory(object):
     def add_burst(self, addr, data_list):
         assert addr % 4 == 0, "Address must be word-aligned"
         index = addr // 4
-        for data in data_list:
-            self.word_view[index] = data
-            index += 1
+        n = len(data_list)
+        assert index + n <= len(self.word_view), \
+            f'Burst at address 0x{addr:08X} of size {n*4} ' + \
+            'runs past the end of memory'
+        self.word_view[index:index + n] = np.asarray(data_list, dtype=np.uint32)
 
     def assert_content(self, addr, data_list):
         assert addr % 4 == 0, "Address must be word-aligned"
         index = addr // 4
         self.log.debug('Checking memory region - addr: 0x%08X, size: %d',
                        addr, len(data_list)*4)
-        for expected in data_list:
-            data = self.word_view[index]
-            assert data == expected, \
-                f'Memory mismatch at address 0x{index*4:08X}: ' + \
-                f'expected 0x{expected:08X}, got 0x{data:08X}'
-            index += 1
-
-
-class AxiWriteSlave(BusMonitor):
+        n = len(data_list)
+        assert index + n <= len(self.word_view), \
+            f'Memory region at address 0x{addr:08X} of size {n*4} ' + \
+            'runs past the end of memory'
+        # no uint32 cast, so values outside its range are reported as a
+        # mismatch instead of failing to convert
+        expected = np.asarray(data_list)
+        actual = self.word_view[index:index + n]
+        if not np.array_equal(actual, expected):
+            i = int(np.argmax(actual != expected))
+            raise AssertionError(
+                f'Memory mismatch at address 0x{(index + i)*4:08X}: ' +
+                f'expected 0x{expected[i]:08X}, got 0x{actual[i]:08X}')
+
+
+class AxiWriteSlave(object):
     # Simplifications:
     # - address should arrive before the last data beat
     # - strobe is always all-ones
@@ -162,48 +215,129 @@ class AxiWriteSlave(BusMonitor):
         'bresp',
     ]
 
-    def __init__(self, dut, name, clock, **kwargs):
-        self.log = logging.getLogger(__class__.__name__)
-        self.want_quit = False
+    def __init__(self, dut, name, clock):
+        self.log = _model_logger(__class__)
+        self.clock = clock
+        self.bus = SimpleNamespace(**{
+            sig: getattr(dut, f'{name}_{sig}') for sig in self._signals})
+        self._callbacks = []
         self.n_bursts = 0
         self.n_resp = 0
-        super().__init__(dut, name, clock, **kwargs)
+        self._addr = None
+        self._burst = None
+        # AXI bursts are at most 256 beats long
+        self._beat_buf = np.empty(256, dtype=np.uint32)
+        self._need_resp = 0
+        self._aw_enable = Event()
+        self._resp_event = Event()
+        self._thread = cocotb.start_soon(self._monitor_recv())
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def _recv(self, transaction):
+        for callback in self._callbacks:
+            callback(transaction)
 
     async def _monitor_recv(self):
-        self.bus.awready.value = 1
-        self.bus.wready.value = 1
-        self.bus.bvalid.value = 0
-        self.bus.bresp.value = 0
-        data_list = []
-        addr = None
-        need_resp = 0
-        while not self.want_quit:
-            await RisingEdge(self.clock)
-            if self.bus.awvalid.value == 1 and self.bus.awready.value == 1:
-                addr = self.bus.awaddr.value.to_unsigned()
-                self.bus.awready.value = 0
-                self.log.debug('AXI Write Slave received address 0x%08X', addr)
-
-            if self.bus.wvalid.value:
-                data_list.append(self.bus.wdata.value.to_unsigned())
-                if self.bus.wlast.value:
-                    self.log.debug(
-                        'AXI Write Slave received burst of %d', len(data_list))
-                    assert addr is not None, \
-                        'Address should be set before last data beat'
-                    self._recv((addr, data_list))
-                    data_list = []
-                    addr = None
-                    need_resp += 1
-                    self.n_bursts += 1
-                    self.bus.awready.value = 1
-
-            self.bus.bvalid.value = 1 if need_resp else 0
-            if self.bus.bvalid.value and self.bus.bready.value:
-                need_resp -= 1
+        # VHDL signal writes are applied inertially even when immediate, so
+        # immediate writes save the scheduler round-trip without changing
+        # the edge the DUT sees them on
+        self.bus.awready.value = Immediate(1)
+        self.bus.wready.value = Immediate(1)
+        self.bus.bvalid.value = Immediate(0)
+        self.bus.bresp.value = Immediate(0)
+        self._aw_enable.set()
+        # Each channel runs in its own coroutine and sleeps on its valid
+        # signal while idle, instead of sampling every signal every cycle
+        tasks = [cocotb.start_soon(handler()) for handler in (
+            self._aw_handler, self._w_handler, self._b_handler)]
+        for task in tasks:
+            await task
+
+    def _complete_burst(self):
+        # address and last data beat may be sampled by different handlers
+        # on the same clock edge, whichever comes second pairs them
+        if self._addr is None or self._burst is None:
+            return
+
+        self._recv((self._addr, self._burst))
+        self._addr = None
+        self._burst = None
+        self._need_resp += 1
+        self.n_bursts += 1
+        self.bus.awready.value = Immediate(1)
+        self._aw_enable.set()
+        self._resp_event.set()
+
+    async def _aw_handler(self):
+        clock = self.clock
+        awvalid = self.bus.awvalid
+        awready = self.bus.awready
+        awaddr = self.bus.awaddr
+        await RisingEdge(clock)
+        while True:
+            # awready is held low until the burst for the current address
+            # has been received
+            await self._aw_enable.wait()
+            if awvalid.value != 1:
+                await RisingEdge(awvalid)
+
+            await RisingEdge(clock)
+            if awvalid.value != 1:
+                continue
+
+            self._addr = awaddr.value.to_unsigned()
+            awready.value = Immediate(0)
+            self._aw_enable.clear()
+            self.log.debug('AXI Write Slave received address 0x%08X',
+                           self._addr)
+            self._complete_burst()
+
+    async def _w_handler(self):
+        clock = self.clock
+        wvalid = self.bus.wvalid
+        wdata = self.bus.wdata
+        wlast = self.bus.wlast
+        awvalid = self.bus.awvalid
+        beat_buf = self._beat_buf
+        n_beats = 0
+        await RisingEdge(clock)
+        while True:
+            if wvalid.value != 1:
+                await RisingEdge(wvalid)
+                await RisingEdge(clock)
+                continue
+
+            beat_buf[n_beats] = wdata.value.to_unsigned()
+            n_beats += 1
+            if wlast.value == 1:
+                self.log.debug(
+                    'AXI Write Slave received burst of %d', n_beats)
+                assert self._addr is not None or awvalid.value == 1, \
+                    'Address should be set before last data beat'
+                self._burst = beat_buf[:n_beats].copy()
+                n_beats = 0
+                self._complete_burst()
+
+            await RisingEdge(clock)
+
+    async def _b_handler(self):
+        clock = self.clock
+        bvalid = self.bus.bvalid
+        bready = self.bus.bready
+        while True:
+            if not self._need_resp:
+                self._resp_event.clear()
+                await self._resp_event.wait()
+                bvalid.value = Immediate(1)
+
+            await RisingEdge(clock)
+            if bready.value == 1:
+                self._need_resp -= 1
                 self.n_resp += 1
-                if not need_resp:
-                    self.bus.bvalid.value = 0
+                if not self._need_resp:
+                    bvalid.value = Immediate(0)
 
 
 class TB(object):
@@ -215,6 +349,10 @@ class TB(object):
         self.addr_driver = PcapAddressDriver(dut, addresses, block_size,
                                              delay_in_irq)
         self.memory = Memory(size=0x00004000)
+        self._init_handles = [dut[attr_name] for attr_name in [
+            'pcap_start_event_i', 'pcap_dat_i', 'pcap_wstb_i', 'pcap_done_i',
+            'pcap_status_i', 'dma_reset', 'dma_init', 'dma_addr',
+            'dma_addr_wstb', 'timeout', 'timeout_wstb']]
         def handle_write(transaction):
             addr, data_list = transaction
             self.memory.add_burst(addr, data_list)
@@ -222,16 +360,12 @@ class TB(object):
         self.slave.add_callback(handle_write)
 
     def init_signals(self):
-        for attr_name in [
-                'pcap_start_event_i', 'pcap_dat_i', 'pcap_wstb_i', 'pcap_done_i',
-                'pcap_status_i', 'dma_reset', 'dma_init', 'dma_addr',
-                'dma_addr_wstb', 'timeout', 'timeout_wstb']:
-            self.dut[attr_name].value = 0
+        for handle in self._init_handles:
+            handle.value = Immediate(0)
 
 
 @cocotb.test()
 async def test_2_buffers_and_finish(dut):
-    logging.basicConfig(level=logging.DEBUG, force=True)
     cocotb.start_soon(Clock(dut.clk_i, 1, 'ns').start(start_high=False))
     tb = TB(dut, addresses=[0x00001000, 0x00002000, 0x00003000],
             block_size=128, delay_in_irq=1)
@@ -246,6 +380,23 @@ async def test_2_buffers_and_finish(dut):
 
 
 def test_pcap_dma():
+    build_args = ['--std=08']
+    run_args = []
+    if not DEBUG_BUILD:
+        build_args += ['-O2', '-frelaxed', '-Wno-hide']
+        run_args += ['--ieee-asserts=disable-at-0']
+
+    if WAVES_PATH:
+        # only dump the scopes listed in the wave option file
+        suffix = Path(WAVES_PATH).suffix
+        if suffix not in WAVE_FORMAT_OPTS:
+            raise ValueError(
+                f'Unknown waveform format for {WAVES_PATH}, expected one of ' +
+                ', '.join(WAVE_FORMAT_OPTS))
+        wave_opt = WAVE_FORMAT_OPTS[suffix]
+        run_args += [f'{wave_opt}={WAVES_PATH}',
+                     f'--read-wave-opt={WAVE_OPT_PATH}']
+
     runner = get_runner('ghdl')
     runner.build(sources=[
                      TOP_PATH / 'common' / 'hdl' / 'defines' / 'support.vhd',
@@ -256,14 +407,13 @@ def test_pcap_dma():
                      TOP_PATH / 'modules' / 'pcap' / 'hdl' / 'axi_write_master.vhd',
                      TOP_PATH / 'modules' / 'pcap' / 'hdl' / 'pcap_dma.vhd',
                  ],
-                 build_args=['--std=08'],
+                 build_args=build_args,
                  build_dir='sim_pcap_dma',
                  hdl_toplevel='pcap_dma',
                  always=True)
     runner.test(hdl_toplevel='pcap_dma',
                 test_args=['--std=08'],
-                plusargs = [
-                    '--fst=pcap_dma.fst',
+                plusargs = run_args + [
                     #'--vpi-trace=/proc/self/fd/0',
                 ],
                 verbose=True,